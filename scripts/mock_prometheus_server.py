@@ -24,83 +24,220 @@ Test with hrmm:
 """
 
 import argparse
+import array
+import bisect
+import itertools
 import math
 import random
+import threading
 import time
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# HELP/TYPE header blocks never change, so build them once at import time
+# instead of re-emitting the literals on every scrape.
+_HDR_HTTP_REQUESTS = (
+    b'# HELP http_requests_total Total number of HTTP requests\n'
+    b'# TYPE http_requests_total counter\n'
+)
+_HDR_CPU_SECONDS = (
+    b'# HELP process_cpu_seconds_total Total CPU time spent\n'
+    b'# TYPE process_cpu_seconds_total counter\n'
+)
+_HDR_CPU_USAGE = (
+    b'# HELP node_cpu_usage_percent Current CPU usage percentage\n'
+    b'# TYPE node_cpu_usage_percent gauge\n'
+)
+_HDR_MEMORY = (
+    b'# HELP process_resident_memory_bytes Resident memory size in bytes\n'
+    b'# TYPE process_resident_memory_bytes gauge\n'
+)
+_HDR_QUEUE_DEPTH = (
+    b'# HELP queue_depth Current queue depth\n'
+    b'# TYPE queue_depth gauge\n'
+)
+_HDR_CONNECTIONS = (
+    b'# HELP active_connections Number of active connections\n'
+    b'# TYPE active_connections gauge\n'
+)
+_HDR_DURATION = (
+    b'# HELP http_request_duration_seconds HTTP request latency\n'
+    b'# TYPE http_request_duration_seconds histogram\n'
+)
+_HDR_SYNTHETIC = (
+    b'# HELP synthetic_gauge_value Synthetic gauge metrics for testing\n'
+    b'# TYPE synthetic_gauge_value gauge\n'
+)
+
+# Raw response for any path other than /metrics. send_error renders an HTML
+# error page per request; misdirected traffic only deserves this constant.
+_NOT_FOUND_RESPONSE = (
+    b'HTTP/1.1 404 Not Found\r\n'
+    b'Content-Length: 0\r\n'
+    b'Connection: close\r\n'
+    b'\r\n'
+)
+
+# Reciprocal of the latency distribution's rate (lambda = 10, mean 0.1s);
+# multiplying by this beats dividing by lambda on every sample.
+_INV_LAMBDA = 0.1
+
+
+# Above this many synthetic series, unrolled codegen stops paying for its
+# compile time and code size and the emitter falls back to a plain loop.
+_SYNTH_UNROLL_LIMIT = 512
+
+
+def _build_synthetic_emitter(prefixes, phases, periods):
+    """Generate a specialized emitter for the synthetic gauge block.
+
+    The series count is fixed at server start, so the per-metric loop can
+    be partially evaluated away: the generated function is straight-line
+    code with each series' prefix, phase, and period baked in as constants,
+    leaving only the sin/gauss arithmetic and value formatting per line.
+    """
+    series = list(zip(prefixes, phases, periods))
+    if len(series) > _SYNTH_UNROLL_LIMIT:
+        def emit(buf, elapsed, gauss, sin):
+            for prefix, phase, period in series:
+                buf += prefix
+                buf += b'%.2f\n' % max(0, 50 + 30 * sin((elapsed + phase) / period) + gauss(0, 5))
+        return emit
+
+    lines = ['def emit(buf, elapsed, gauss, sin):']
+    for prefix, phase, period in series:
+        lines.append(f'    buf += {prefix!r}')
+        lines.append(
+            f"    buf += b'%.2f\\n' % max(0, 50 + 30 * sin((elapsed + {phase!r}) / {period!r}) + gauss(0, 5))"
+        )
+    lines.append('    return None')
+    namespace = {}
+    exec(compile('\n'.join(lines), '<synthetic-emitter>', 'exec'), namespace)
+    return namespace['emit']
+
+
+def _ingest_latencies(buckets, counts, n, rand):
+    """Draw n exponential latency samples, bucket them, return their sum.
+
+    This is the hottest loop in the server, so it lives in a free function
+    where everything it touches is a local or an argument rather than an
+    attribute chained off self. The exponential draw (mean 0.1s) is
+    random.expovariate(10) inlined against the supplied rand() callable,
+    saving the method dispatch and division per sample. The whole batch is
+    drawn in one comprehension and summed by the C-level sum(), then
+    classified in a second pass.
+    """
+    log = math.log
+    inv_lambda = _INV_LAMBDA
+    # rand() is in [0, 1), so 1-u is in (0, 1] and log never sees 0.
+    latencies = [-log(1.0 - rand()) * inv_lambda for _ in range(n)]
+    find_bucket = bisect.bisect_left
+    for latency in latencies:
+        counts[find_bucket(buckets, latency)] += 1
+    return sum(latencies)
 
 
 class MetricsState:
     """Maintains state for all metrics between requests."""
 
-    def __init__(self, metric_count: int = 10):
+    def __init__(self, metric_count: int = 10, cache_ttl: float = 1.0):
         self.start_time = time.time()
         self.request_count = 0
         self.metric_count = metric_count
 
-        # Counter state (monotonically increasing)
-        self.http_requests_total = {
-            'method="GET",code="200"': 0,
-            'method="GET",code="404"': 0,
-            'method="POST",code="200"': 0,
-            'method="POST",code="500"': 0,
-        }
-
-        # Histogram state
+        # Serializes update() now that requests are handled on separate
+        # threads; plain int/list mutation here is not thread-safe.
+        self.lock = threading.Lock()
+
+        # Scrapes arriving within cache_ttl seconds of each other reuse the
+        # last rendered payload, so a herd of HA replicas costs one render.
+        self.cache_ttl = cache_ttl
+        self._cache_bytes = None
+        self._cache_ts = 0.0
+
+        # Per-metric phase/period for the synthetic gauges, fixed for the
+        # lifetime of the server, so the scrape loop only does arithmetic.
+        self._synth_phases = [i * 0.5 for i in range(metric_count)]
+        self._synth_periods = [10.0 + i for i in range(metric_count)]
+        self._synth_prefixes = [
+            b'synthetic_gauge_value{instance="%d",job="mock"} ' % i
+            for i in range(metric_count)
+        ]
+        self._emit_synthetic = _build_synthetic_emitter(
+            self._synth_prefixes, self._synth_phases, self._synth_periods)
+
+        # Private RNG so the hot path skips the module-level Random's
+        # attribute lookups; _rand is the bound method itself.
+        self._rng = random.Random()
+        self._rand = self._rng.random
+
+        # Counter state (monotonically increasing). The label sets are fixed,
+        # so each series' rendered prefix is encoded once here and only the
+        # count is formatted per scrape; counts sit in a parallel list.
+        self._http_prefixes = [
+            b'http_requests_total{method="GET",code="200"} ',
+            b'http_requests_total{method="GET",code="404"} ',
+            b'http_requests_total{method="POST",code="200"} ',
+            b'http_requests_total{method="POST",code="500"} ',
+        ]
+        self._http_counts = [0, 0, 0, 0]
+
+        # Histogram state. Per-bucket counts live in a contiguous int64
+        # array indexed by bucket position (last slot is +Inf) and
+        # latency_cum holds the already-cumulative counts the scrape path
+        # emits, refreshed once per update(). The le="..." prefix of each
+        # bucket line is rendered once here.
         self.latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
-        self.latency_counts = {b: 0 for b in self.latency_buckets}
-        self.latency_counts[float('inf')] = 0
+        self.latency_counts = array.array('q', [0] * (len(self.latency_buckets) + 1))
+        self.latency_cum = array.array('q', self.latency_counts)
         self.latency_sum = 0.0
         self.latency_count = 0
+        self._bucket_prefixes = [
+            f'http_request_duration_seconds_bucket{{le="{b}"}} '.encode('ascii')
+            for b in self.latency_buckets
+        ]
 
     def update(self):
         """Simulate metric changes between scrapes."""
         self.request_count += 1
 
         # Update counters (simulate traffic)
-        self.http_requests_total['method="GET",code="200"'] += random.randint(10, 100)
-        self.http_requests_total['method="GET",code="404"'] += random.randint(0, 5)
-        self.http_requests_total['method="POST",code="200"'] += random.randint(5, 50)
-        self.http_requests_total['method="POST",code="500"'] += random.randint(0, 2)
-
-        # Simulate some requests for histogram
-        for _ in range(random.randint(10, 50)):
-            latency = random.expovariate(10)  # Exponential distribution, mean 0.1s
-            self.latency_sum += latency
-            self.latency_count += 1
-            for bucket in self.latency_buckets:
-                if latency <= bucket:
-                    self.latency_counts[bucket] += 1
-            self.latency_counts[float('inf')] += 1
-
-    def get_cpu_usage(self) -> float:
-        """Simulate CPU usage with sinusoidal pattern + noise."""
-        elapsed = time.time() - self.start_time
-        base = 30 + 20 * math.sin(elapsed / 60)  # 30-50% base with 1-min cycle
-        noise = random.gauss(0, 5)
-        return max(0, min(100, base + noise))
-
-    def get_memory_bytes(self) -> int:
-        """Simulate memory usage with gradual increase + GC drops."""
-        elapsed = time.time() - self.start_time
-        base = 500_000_000  # 500MB base
-        growth = int(elapsed * 100_000)  # Slow growth
-        gc_cycle = int(50_000_000 * (1 + math.sin(elapsed / 30)))  # GC fluctuation
-        return base + growth % 200_000_000 + gc_cycle
-
-    def get_queue_depth(self) -> int:
-        """Simulate queue depth with random walk."""
-        elapsed = time.time() - self.start_time
-        base = 10 + 5 * math.sin(elapsed / 20)
-        noise = random.randint(-3, 5)
-        return max(0, int(base + noise))
-
-    def get_active_connections(self) -> int:
-        """Simulate active connections."""
-        elapsed = time.time() - self.start_time
-        base = 50 + 30 * math.sin(elapsed / 45)
-        noise = random.randint(-10, 15)
-        return max(0, int(base + noise))
+        counts = self._http_counts
+        counts[0] += random.randint(10, 100)  # GET 200
+        counts[1] += random.randint(0, 5)     # GET 404
+        counts[2] += random.randint(5, 50)    # POST 200
+        counts[3] += random.randint(0, 2)     # POST 500
+
+        # Simulate some requests for histogram. Each sample lands in exactly
+        # one bucket slot via binary search; the cumulative view is rebuilt
+        # once per batch instead of walking every bucket per sample.
+        n = int(self._rand() * 41) + 10
+        self.latency_sum += _ingest_latencies(self.latency_buckets, self.latency_counts, n, self._rand)
+        self.latency_count += n
+        self.latency_cum = array.array('q', itertools.accumulate(self.latency_counts))
+
+    def _compute_gauges(self, elapsed: float, cpu_noise: float,
+                        queue_noise: int, conn_noise: int):
+        """Compute all scalar gauges for one scrape from a shared elapsed.
+
+        Returns (cpu_usage, memory_bytes, queue_depth, active_connections).
+        """
+        sin = math.sin
+
+        # CPU: 30-50% base with 1-min cycle plus noise
+        cpu = max(0, min(100, 30 + 20 * sin(elapsed / 60) + cpu_noise))
+
+        # Memory: 500MB base plus a slow sawtooth (the modulo bounds only the
+        # growth term, resetting it every ~33 days) plus a GC fluctuation
+        growth = int(elapsed * 100_000)
+        gc_cycle = int(50_000_000 * (1 + sin(elapsed / 30)))
+        memory = 500_000_000 + (growth % 200_000_000) + gc_cycle
+
+        # Queue depth and connections: sinusoidal base plus noise
+        queue = max(0, int(10 + 5 * sin(elapsed / 20) + queue_noise))
+        conns = max(0, int(50 + 30 * sin(elapsed / 45) + conn_noise))
+
+        return cpu, memory, queue, conns
 
 
 class PrometheusHandler(BaseHTTPRequestHandler):
@@ -108,95 +245,110 @@ class PrometheusHandler(BaseHTTPRequestHandler):
 
     state: MetricsState = None
 
+    # BaseHTTPRequestHandler defaults to an unbuffered wfile, which turns a
+    # multi-KB response into many small send()s; buffer the writes and turn
+    # off Nagle so the flushed payload goes out immediately.
+    wbufsize = 65536
+    disable_nagle_algorithm = True
+
     def do_GET(self):
         if self.path != '/metrics':
-            self.send_error(404)
+            self.wfile.write(_NOT_FOUND_RESPONSE)
+            self.close_connection = True
             return
 
-        self.state.update()
+        now = time.time()
+        with self.state.lock:
+            payload = self.state._cache_bytes
+            if payload is None or now - self.state._cache_ts >= self.state.cache_ttl:
+                self.state.update()
+                payload = self.generate_metrics(now)
+                self.state._cache_bytes = payload
+                self.state._cache_ts = now
 
         self.send_response(200)
         self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
         self.end_headers()
 
-        metrics = self.generate_metrics()
-        self.wfile.write(metrics.encode('utf-8'))
-
-    def generate_metrics(self) -> str:
-        lines = []
+        # memoryview lets the buffered writer slice the payload without
+        # copying it, which matters for large --metrics values.
+        self.wfile.write(memoryview(payload))
+
+    def generate_metrics(self, now: float) -> bytearray:
+        # Assemble the payload into a single bytearray instead of a list of
+        # str fragments: one growing buffer, no '\n'.join and no final
+        # .encode('utf-8') copy of the whole response. One time snapshot
+        # serves the whole scrape rather than one syscall per gauge.
+        buf = bytearray()
+        elapsed = now - self.state.start_time
+
+        # Draw this scrape's noise in one place from the state RNG rather
+        # than one global-Random call per gauge.
+        rng = self.state._rng
+        cpu_noise = rng.gauss(0, 5)
+        queue_noise = rng.randint(-3, 5)
+        conn_noise = rng.randint(-10, 15)
+        cpu_usage, memory_bytes, queue_depth, active_connections = \
+            self.state._compute_gauges(elapsed, cpu_noise, queue_noise, conn_noise)
 
         # Counter: http_requests_total
-        lines.append('# HELP http_requests_total Total number of HTTP requests')
-        lines.append('# TYPE http_requests_total counter')
-        for labels, count in self.state.http_requests_total.items():
-            lines.append(f'http_requests_total{{{labels}}} {count}')
+        buf += _HDR_HTTP_REQUESTS
+        for prefix, count in zip(self.state._http_prefixes, self.state._http_counts):
+            buf += prefix
+            buf += b'%d\n' % count
 
-        lines.append('')
+        buf += b'\n'
 
         # Counter: process_cpu_seconds_total
-        cpu_seconds = time.time() - self.state.start_time
-        lines.append('# HELP process_cpu_seconds_total Total CPU time spent')
-        lines.append('# TYPE process_cpu_seconds_total counter')
-        lines.append(f'process_cpu_seconds_total {cpu_seconds:.2f}')
+        buf += _HDR_CPU_SECONDS
+        buf += b'process_cpu_seconds_total %.2f\n' % elapsed
 
-        lines.append('')
+        buf += b'\n'
 
         # Gauge: node_cpu_usage_percent
-        lines.append('# HELP node_cpu_usage_percent Current CPU usage percentage')
-        lines.append('# TYPE node_cpu_usage_percent gauge')
-        lines.append(f'node_cpu_usage_percent {self.state.get_cpu_usage():.2f}')
+        buf += _HDR_CPU_USAGE
+        buf += b'node_cpu_usage_percent %.2f\n' % cpu_usage
 
-        lines.append('')
+        buf += b'\n'
 
         # Gauge: process_resident_memory_bytes
-        lines.append('# HELP process_resident_memory_bytes Resident memory size in bytes')
-        lines.append('# TYPE process_resident_memory_bytes gauge')
-        lines.append(f'process_resident_memory_bytes {self.state.get_memory_bytes()}')
+        buf += _HDR_MEMORY
+        buf += b'process_resident_memory_bytes %d\n' % memory_bytes
 
-        lines.append('')
+        buf += b'\n'
 
         # Gauge: queue_depth
-        lines.append('# HELP queue_depth Current queue depth')
-        lines.append('# TYPE queue_depth gauge')
-        lines.append(f'queue_depth {self.state.get_queue_depth()}')
+        buf += _HDR_QUEUE_DEPTH
+        buf += b'queue_depth %d\n' % queue_depth
 
-        lines.append('')
+        buf += b'\n'
 
         # Gauge: active_connections
-        lines.append('# HELP active_connections Number of active connections')
-        lines.append('# TYPE active_connections gauge')
-        lines.append(f'active_connections {self.state.get_active_connections()}')
+        buf += _HDR_CONNECTIONS
+        buf += b'active_connections %d\n' % active_connections
 
-        lines.append('')
+        buf += b'\n'
 
         # Histogram: http_request_duration_seconds
-        lines.append('# HELP http_request_duration_seconds HTTP request latency')
-        lines.append('# TYPE http_request_duration_seconds histogram')
-        cumulative = 0
-        for bucket in self.state.latency_buckets:
-            cumulative += self.state.latency_counts[bucket]
-            lines.append(f'http_request_duration_seconds_bucket{{le="{bucket}"}} {cumulative}')
-        cumulative += self.state.latency_counts[float('inf')]
-        lines.append(f'http_request_duration_seconds_bucket{{le="+Inf"}} {cumulative}')
-        lines.append(f'http_request_duration_seconds_sum {self.state.latency_sum:.6f}')
-        lines.append(f'http_request_duration_seconds_count {self.state.latency_count}')
-
-        lines.append('')
+        buf += _HDR_DURATION
+        for prefix, cumulative in zip(self.state._bucket_prefixes, self.state.latency_cum):
+            buf += prefix
+            buf += b'%d\n' % cumulative
+        buf += b'http_request_duration_seconds_bucket{le="+Inf"} %d\n' % self.state.latency_cum[-1]
+        buf += b'http_request_duration_seconds_sum %.6f\n' % self.state.latency_sum
+        buf += b'http_request_duration_seconds_count %d\n' % self.state.latency_count
+
+        buf += b'\n'
 
         # Dynamic gauges based on --metrics flag
         if self.state.metric_count > 0:
-            lines.append('# HELP synthetic_gauge_value Synthetic gauge metrics for testing')
-            lines.append('# TYPE synthetic_gauge_value gauge')
-            for i in range(self.state.metric_count):
-                # Each synthetic metric has its own pattern
-                elapsed = time.time() - self.state.start_time
-                phase = i * 0.5  # Different phase for each metric
-                base = 50 + 30 * math.sin((elapsed + phase) / (10 + i))
-                noise = random.gauss(0, 5)
-                value = max(0, base + noise)
-                lines.append(f'synthetic_gauge_value{{instance="{i}",job="mock"}} {value:.2f}')
-
-        return '\n'.join(lines) + '\n'
+            buf += _HDR_SYNTHETIC
+            # Each synthetic metric has its own phase/period pattern, baked
+            # into the emitter specialized at construction time.
+            self.state._emit_synthetic(buf, elapsed, rng.gauss, math.sin)
+
+        return buf
 
     def log_message(self, format, *args):
         """Override to show cleaner log output."""
@@ -219,12 +371,21 @@ def main():
         default=10,
         help='Number of synthetic gauge metrics to generate (default: 10)'
     )
+    parser.add_argument(
+        '--cache-ttl',
+        type=float,
+        default=1.0,
+        help='Seconds to reuse a rendered response between scrapes; 0 disables (default: 1.0)'
+    )
 
     args = parser.parse_args()
 
-    PrometheusHandler.state = MetricsState(metric_count=args.metrics)
+    PrometheusHandler.state = MetricsState(
+        metric_count=args.metrics,
+        cache_ttl=args.cache_ttl,
+    )
 
-    server = HTTPServer(('', args.port), PrometheusHandler)
+    server = ThreadingHTTPServer(('', args.port), PrometheusHandler)
     print(f'Mock Prometheus server running on http://localhost:{args.port}/metrics')
     print(f'Generating {args.metrics} synthetic gauge metrics')
     print('')